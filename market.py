@@ -1,140 +1,167 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
 from seller import download_stock
 
-import requests
+import aiohttp
+import orjson
 
-from seller import divide, price_conversion
+from seller import (
+    divide,
+    gather_limited,
+    index_remnants,
+    price_conversion,
+    request_with_retry,
+)
 
 logger = logging.getLogger(__file__)
 
+_ENDPOINT_URL = "https://api.partner.market.yandex.ru/"
+_OFFER_MAPPING_URL = _ENDPOINT_URL + "campaigns/{campaign_id}/offer-mapping-entries"
+_STOCKS_URL = _ENDPOINT_URL + "campaigns/{campaign_id}/offers/stocks"
+_PRICES_URL = _ENDPOINT_URL + "campaigns/{campaign_id}/offer-prices/updates"
 
-def get_product_list(page, campaign_id, access_token):
+_STOCK_BY_COUNT = {">10": 100, "1": 0}
+
+
+def make_session():
+    """Создать aiohttp-сессию с общим пулом соединений для запросов к API Яндекс Маркета.
+
+    Returns:
+        aiohttp.ClientSession: Сессия с пулом соединений и кэшем DNS.
+
+    Примеры:
+        Корректное использование:
+        >>> async with make_session() as session:
+        ...     product_list = await get_product_list("", "12345", "ваш_токен", session)
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75, ttl_dns_cache=300),
+        headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Host": "api.partner.market.yandex.ru",
+        },
+    )
+
+
+async def get_product_list(page, campaign_id, access_token, session):
     """Получить список товаров для заданной кампании.
 
     Args:
         page (str): Токен страницы для пагинации.
         campaign_id (str): Идентификатор кампании.
         access_token (str): Токен доступа к API.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         list: Список товаров в кампании.
 
     Примеры:
         Корректное использование:
-        >>> product_list = get_product_list("", "12345", "ваш_токен")
+        >>> product_list = await get_product_list("", "12345", "ваш_токен", session)
 
         Некорректное использование:
-        >>> product_list = get_product_list("", None, "ваш_токен")
+        >>> product_list = await get_product_list("", None, "ваш_токен", session)
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    url = _OFFER_MAPPING_URL.format(campaign_id=campaign_id)
+    response_object = await request_with_retry(
+        session, "GET", url, headers=headers, params=payload
+    )
     return response_object.get("result")
 
 
-def update_stocks(stocks, campaign_id, access_token):
+async def update_stocks(stocks, campaign_id, access_token, session):
     """Обновить остатки товаров для заданной кампании.
 
     Args:
         stocks (list): Список остатков товаров.
         campaign_id (str): Идентификатор кампании.
         access_token (str): Токен доступа к API.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         dict: Ответ API после обновления остатков.
 
     Примеры:
         Корректное использование:
-        >>> update_response = update_stocks(stocks, "12345", "ваш_токен")
+        >>> update_response = await update_stocks(stocks, "12345", "ваш_токен", session)
 
         Некорректное использование:
-        >>> update_response = update_stocks(None, "12345", "ваш_токен")
+        >>> update_response = await update_stocks(None, "12345", "ваш_токен", session)
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    url = _STOCKS_URL.format(campaign_id=campaign_id)
+    return await request_with_retry(
+        session, "PUT", url, headers=headers, data=orjson.dumps(payload)
+    )
 
 
-def update_price(prices, campaign_id, access_token):
+async def update_price(prices, campaign_id, access_token, session):
     """Обновить цены товаров для заданной кампании.
 
     Args:
         prices (list): Список цен товаров.
         campaign_id (str): Идентификатор кампании.
         access_token (str): Токен доступа к API.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         dict: Ответ API после обновления цен.
 
     Примеры:
         Корректное использование:
-        >>> update_response = update_price(prices, "12345", "ваш_токен")
+        >>> update_response = await update_price(prices, "12345", "ваш_токен", session)
 
         Некорректное использование:
-        >>> update_response = update_price(None, "12345", "ваш_токен")
+        >>> update_response = await update_price(None, "12345", "ваш_токен", session)
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    url = _PRICES_URL.format(campaign_id=campaign_id)
+    return await request_with_retry(
+        session, "POST", url, headers=headers, data=orjson.dumps(payload)
+    )
 
 
-def get_offer_ids(campaign_id, market_token):
+async def get_offer_ids(campaign_id, market_token, session):
     """Получить артикулы товаров Яндекс маркета.
 
     Args:
         campaign_id (str): Идентификатор кампании.
         market_token (str): Токен доступа к API.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         list: Список артикулов товаров.
 
     Примеры:
         Корректное использование:
-        >>> offer_ids = get_offer_ids("12345", "ваш_токен")
+        >>> offer_ids = await get_offer_ids("12345", "ваш_токен", session)
 
         Некорректное использование:
-        >>> offer_ids = get_offer_ids(None, "ваш_токен")
+        >>> offer_ids = await get_offer_ids(None, "ваш_токен", session)
     """
-    page = ""
     product_list = []
+    # Следующая страница запрашивается, пока обрабатывается текущая
+    next_page = asyncio.create_task(
+        get_product_list("", campaign_id, market_token, session)
+    )
     while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        some_prod = await next_page
         page = some_prod.get("paging").get("nextPageToken")
+        if page:
+            next_page = asyncio.create_task(
+                get_product_list(page, campaign_id, market_token, session)
+            )
+        product_list.extend(some_prod.get("offerMappingEntries"))
         if not page:
             break
     offer_ids = []
@@ -161,43 +188,32 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
         Некорректное использование:
         >>> stocks = create_stocks([], None, "ваш_склад_id")
     """
+    remnants_by_code = index_remnants(watch_remnants)
     stocks = []
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
+    date = (
+        datetime.datetime.now(datetime.timezone.utc)
+        .replace(microsecond=0)
+        .isoformat()
+        .replace("+00:00", "Z")
+    )
+
+    def make_items(count):
+        return [{"count": count, "type": "FIT", "updatedAt": date}]
+
+    for offer_id in set(map(str, offer_ids)):
+        watch = remnants_by_code.get(offer_id)
+        if watch is None:
+            stock = 0
+        else:
+            quantity = watch["Количество"]
+            stock = _STOCK_BY_COUNT.get(str(quantity))
+            if stock is None:
+                stock = int(quantity)
         stocks.append(
             {
                 "sku": offer_id,
                 "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
+                "items": make_items(stock),
             }
         )
     return stocks
@@ -220,75 +236,105 @@ def create_prices(watch_remnants, offer_ids):
         Некорректное использование:
         >>> prices = create_prices([], None)
     """
+    remnants_by_code = index_remnants(watch_remnants)
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    "currencyId": "RUR",
-                },
-            }
-            prices.append(price)
+    for offer_id in set(map(str, offer_ids)):
+        watch = remnants_by_code.get(offer_id)
+        if watch is None:
+            continue
+        price = {
+            "id": offer_id,
+            "price": {
+                "value": int(price_conversion(watch["Цена"])),
+                "currencyId": "RUR",
+            },
+        }
+        prices.append(price)
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, offer_ids, campaign_id, market_token, session):
     """Загрузить цены для кампании.
 
     Args:
         watch_remnants (list): Список остатков товаров.
+        offer_ids (list): Список артикулов товаров кампании.
         campaign_id (str): Идентификатор кампании.
         market_token (str): Токен доступа к API.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         list: Список обновленных цен.
 
     Примеры:
         Корректное использование:
-        >>> prices = await upload_prices(watch_remnants, "12345", "ваш_токен")
+        >>> prices = await upload_prices(watch_remnants, offer_ids, "12345", "ваш_токен", session)
 
         Некорректное использование:
-        >>> prices = await upload_prices([], None, "ваш_токен")
+        >>> prices = await upload_prices([], None, "12345", "ваш_токен", session)
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await gather_limited(
+        update_price(some_prices, campaign_id, market_token, session)
+        for some_prices in divide(prices, 500)
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(watch_remnants, offer_ids, campaign_id, market_token, warehouse_id, session):
     """Загрузить остатки для кампании.
 
     Args:
         watch_remnants (list): Список остатков товаров.
+        offer_ids (list): Список артикулов товаров кампании.
         campaign_id (str): Идентификатор кампании.
         market_token (str): Токен доступа к API.
         warehouse_id (str): Идентификатор склада.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
 
     Returns:
         tuple: Кортеж из списка непустых остатков и полного списка остатков.
 
     Примеры:
         Корректное использование:
-        >>> not_empty, all_stocks = await upload_stocks(watch_remnants, "12345", "ваш_токен", "ваш_склад_id")
+        >>> not_empty, all_stocks = await upload_stocks(watch_remnants, offer_ids, "12345", "ваш_токен", "ваш_склад_id", session)
 
         Некорректное использование:
         >>> not_empty, all_stocks =
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    await gather_limited(
+        update_stocks(some_stock, campaign_id, market_token, session)
+        for some_stock in divide(stocks, 2000)
     )
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
-def main():
+async def process_campaign(watch_remnants, campaign_id, market_token, warehouse_id, session):
+    """Обновить остатки и цены товаров одной кампании.
+
+    Args:
+        watch_remnants (list): Список остатков товаров.
+        campaign_id (str): Идентификатор кампании.
+        market_token (str): Токен доступа к API.
+        warehouse_id (str): Идентификатор склада.
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+
+    Примеры:
+        Корректное использование:
+        >>> await process_campaign(watch_remnants, "12345", "ваш_токен", "ваш_склад_id", session)
+    """
+    offer_ids = await get_offer_ids(campaign_id, market_token, session)
+    # Обновить остатки
+    await upload_stocks(
+        watch_remnants, offer_ids, campaign_id, market_token, warehouse_id, session
+    )
+    # Поменять цены
+    await upload_prices(watch_remnants, offer_ids, campaign_id, market_token, session)
+
+
+async def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -298,30 +344,31 @@ def main():
 
     watch_remnants = download_stock()
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
+        async with make_session() as session:
+            # FBS и DBS независимы и обрабатываются параллельно
+            await asyncio.gather(
+                process_campaign(
+                    watch_remnants,
+                    campaign_fbs_id,
+                    market_token,
+                    warehouse_fbs_id,
+                    session,
+                ),
+                process_campaign(
+                    watch_remnants,
+                    campaign_dbs_id,
+                    market_token,
+                    warehouse_dbs_id,
+                    session,
+                ),
+            )
+    except asyncio.TimeoutError:
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except aiohttp.ClientConnectionError as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,33 +1,137 @@
-import io
+import asyncio
+import functools
 import logging.config
 import os
+import pickle
 import re
+import shutil
+import tempfile
 import zipfile
+from itertools import islice
+
 from environs import Env
 
+import aiohttp
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+_NON_DIGIT = re.compile(r"[^0-9]")
+
+_STOCK_BY_COUNT = {">10": 100, "1": 0}
+
+_PRODUCT_LIST_FILTER = {"visibility": "ALL"}
+
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+_STOCK_CACHE_DIR = ".stock_cache"
+_STOCK_ETAG_FILE = os.path.join(_STOCK_CACHE_DIR, "etag")
+_STOCK_REMNANTS_FILE = os.path.join(_STOCK_CACHE_DIR, "watch_remnants.pkl")
+
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=sorted(_RETRY_STATUSES),
+        ),
+    ),
+)
+
+
+def make_session():
+    """Создать aiohttp-сессию с общим пулом соединений для запросов к API Ozon.
+
+    Returns:
+        aiohttp.ClientSession: Сессия с пулом соединений и кэшем DNS.
+
+    Пример корректного использования:
+        >>> async with make_session() as session:
+        ...     result = await get_product_list("0", "client_id", "token", session)
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75, ttl_dns_cache=300),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def request_with_retry(session, method, url, retries=5, backoff_factor=0.5, **kwargs):
+    """Выполнить запрос к API, повторяя его при ответах 429 и 5xx.
+
+    Args:
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+        method (str): HTTP-метод запроса.
+        url (str): Адрес запроса.
+        retries (int): Максимальное количество попыток.
+        backoff_factor (float): Базовая задержка между попытками в секундах.
+        **kwargs: Остальные параметры запроса aiohttp.
+
+    Returns:
+        dict: Разобранный JSON-ответ API.
+
+    Пример корректного использования:
+        >>> await request_with_retry(session, "POST", url, json=payload)
+        {"result": {...}}
+    """
+    for attempt in range(retries):
+        async with session.request(method, url, **kwargs) as response:
+            if response.status in _RETRY_STATUSES and attempt < retries - 1:
+                retry_after = response.headers.get("Retry-After")
+                delay = float(retry_after) if retry_after else backoff_factor * 2**attempt
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            return orjson.loads(await response.read())
+
+
+async def gather_limited(coros, limit=4):
+    """Выполнить корутины параллельно, ограничив число одновременных запросов.
+
+    Args:
+        coros (iterable): Корутины для выполнения.
+        limit (int): Максимальное количество одновременно выполняемых корутин.
+
+    Returns:
+        list: Результаты корутин в порядке их передачи.
+
+    Пример корректного использования:
+        >>> await gather_limited(update_price(p, client_id, token, session) for p in divide(prices, 1000))
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
 
-def get_product_list(last_id, client_id, seller_token):
+    return await asyncio.gather(*(bounded(coro) for coro in coros))
+
+
+async def get_product_list(last_id, client_id, seller_token, session):
     """Получить список товаров магазина на платформе Ozon.
     
     Args:
         last_id (str): Идентификатор последнего элемента, используемый для получения следующей страницы.
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+
     Returns:
         dict: Словарь с информацией о товарах.
-        
+
     Пример корректного использования:
-        >>> get_product_list("0", "client_id_example", "seller_token_example")
+        >>> await get_product_list("0", "client_id_example", "seller_token_example", session)
         {"items": [...], "total": 123, ...}
-    
+
     Пример некорректного использования:
-        >>> get_product_list(123, None, "token")
+        >>> await get_product_list(123, None, "token", session)
         TypeError: Expected str for last_id and client_id, got int and None.
     """
     url = "https://api-seller.ozon.ru/v2/product/list"
@@ -36,68 +140,65 @@ def get_product_list(last_id, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {
-        "filter": {
-            "visibility": "ALL",
-        },
+        "filter": _PRODUCT_LIST_FILTER,
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    response_object = await request_with_retry(
+        session, "POST", url, json=payload, headers=headers
+    )
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+async def get_offer_ids(client_id, seller_token, session):
     """Получить артикулы всех товаров магазина Ozon.
-    
+
     Args:
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+
     Returns:
-        list: Список артикулов товаров.
-        
+        set: Множество артикулов товаров.
+
     Пример корректного использования:
-        >>> get_offer_ids("client_id_example", "seller_token_example")
-        ["offer_id_1", "offer_id_2", ...]
-    
+        >>> await get_offer_ids("client_id_example", "seller_token_example", session)
+        {"offer_id_1", "offer_id_2", ...}
+
     Пример некорректного использования:
-        >>> get_offer_ids(123, None)
+        >>> await get_offer_ids(123, None, session)
         TypeError: Expected str for client_id and seller_token, got int and None.
     """
     last_id = ""
     product_list = []
     while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
+        some_prod = await get_product_list(last_id, client_id, seller_token, session)
         product_list.extend(some_prod.get("items"))
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
         if total == len(product_list):
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
-    return offer_ids
+    return {product.get("offer_id") for product in product_list}
 
 
-def update_price(prices: list, client_id, seller_token):
+async def update_price(prices: list, client_id, seller_token, session):
     """Обновить цены товаров на платформе Ozon.
-    
+
     Args:
         prices (list): Список цен для обновления.
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+
     Returns:
         dict: Результат обновления цен.
-        
+
     Пример корректного использования:
-        >>> update_price([{"offer_id": "123", "price": "5990"}], "client_id", "token")
+        >>> await update_price([{"offer_id": "123", "price": "5990"}], "client_id", "token", session)
         {"status": "success"}
-    
+
     Пример некорректного использования:
-        >>> update_price("not_a_list", 123, None)
+        >>> await update_price("not_a_list", 123, None, session)
         TypeError: Expected list for prices and str for client_id and seller_token.
     """
     url = "https://api-seller.ozon.ru/v1/product/import/prices"
@@ -106,28 +207,29 @@ def update_price(prices: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return await request_with_retry(
+        session, "POST", url, data=orjson.dumps(payload), headers=headers
+    )
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+async def update_stocks(stocks: list, client_id, seller_token, session):
     """Обновить остатки товаров на платформе Ozon.
-    
+
     Args:
         stocks (list): Список остатков для обновления.
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+
     Returns:
         dict: Результат обновления остатков.
-        
+
     Пример корректного использования:
-        >>> update_stocks([{"offer_id": "123", "stock": 10}], "client_id", "token")
+        >>> await update_stocks([{"offer_id": "123", "stock": 10}], "client_id", "token", session)
         {"status": "success"}
-    
+
     Пример некорректного использования:
-        >>> update_stocks("not_a_list", 123, None)
+        >>> await update_stocks("not_a_list", 123, None, session)
         TypeError: Expected list for stocks and str for client_id and seller_token.
     """
     url = "https://api-seller.ozon.ru/v1/product/import/stocks"
@@ -136,9 +238,9 @@ def update_stocks(stocks: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return await request_with_retry(
+        session, "POST", url, data=orjson.dumps(payload), headers=headers
+    )
 
 
 def download_stock():
@@ -156,23 +258,63 @@ def download_stock():
     """
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    # Если файл на сайте не менялся, сервер ответит 304 и скачивание,
+    # распаковка и разбор Excel пропускаются целиком
+    headers = {}
+    if os.path.exists(_STOCK_ETAG_FILE) and os.path.exists(_STOCK_REMNANTS_FILE):
+        with open(_STOCK_ETAG_FILE) as etag_file:
+            headers["If-None-Match"] = etag_file.read().strip()
+    response = _session.get(casio_url, headers=headers, stream=True)
+    if response.status_code == 304:
+        with open(_STOCK_REMNANTS_FILE, "rb") as cache_file:
+            return pickle.load(cache_file)
     response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    # Создаем список остатков часов, не записывая файл на диск:
+    # небольшие архивы остаются в памяти, крупные уходят во временный файл
+    with response, tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as buffer:
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, buffer)
+        buffer.seek(0)
+        with zipfile.ZipFile(buffer) as archive:
+            with archive.open("ostatki.xls") as excel_file:
+                watch_remnants = pd.read_excel(
+                    io=excel_file,
+                    na_values=None,
+                    keep_default_na=False,
+                    header=17,
+                    usecols=["Код", "Количество", "Цена"],
+                    engine="calamine",
+                ).to_dict(orient="records")
+    etag = response.headers.get("ETag")
+    if etag:
+        os.makedirs(_STOCK_CACHE_DIR, exist_ok=True)
+        with open(_STOCK_REMNANTS_FILE, "wb") as cache_file:
+            pickle.dump(watch_remnants, cache_file)
+        with open(_STOCK_ETAG_FILE, "w") as etag_file:
+            etag_file.write(etag)
     return watch_remnants
 
 
+def index_remnants(watch_remnants):
+    """Построить индекс остатков по коду товара.
+
+    Args:
+        watch_remnants (list): Список остатков товаров, загруженных с сайта Casio.
+
+    Returns:
+        dict: Отображение кода товара на строку остатков. Для повторяющихся
+        кодов сохраняется первая строка.
+
+    Пример корректного использования:
+        >>> index_remnants([{"Код": "123", "Количество": "10"}])
+        {"123": {"Код": "123", "Количество": "10"}}
+    """
+    remnants_by_code = {}
+    for watch in watch_remnants:
+        remnants_by_code.setdefault(str(watch["Код"]), watch)
+    return remnants_by_code
+
+
 def create_stocks(watch_remnants, offer_ids):
     """Создать список остатков для обновления на Ozon.
     
@@ -191,22 +333,20 @@ def create_stocks(watch_remnants, offer_ids):
         >>> create_stocks("not_a_list", "not_a_list")
         TypeError: Expected list for watch_remnants and offer_ids.
     """
-    # Уберем то, что не загружено в seller
+    # Индексируем остатки по коду и проходим по артикулам магазина:
+    # для товаров без остатков выгружается ноль
+    remnants_by_code = index_remnants(watch_remnants)
     stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
+    for offer_id in set(map(str, offer_ids)):
+        watch = remnants_by_code.get(offer_id)
+        if watch is None:
+            stocks.append({"offer_id": offer_id, "stock": 0})
+            continue
+        quantity = watch["Количество"]
+        stock = _STOCK_BY_COUNT.get(str(quantity))
+        if stock is None:
+            stock = int(quantity)
+        stocks.append({"offer_id": offer_id, "stock": stock})
     return stocks
 
 
@@ -228,20 +368,24 @@ def create_prices(watch_remnants, offer_ids):
         >>> create_prices("not_a_list", "not_a_list")
         TypeError: Expected list for watch_remnants and offer_ids.
     """
+    remnants_by_code = index_remnants(watch_remnants)
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    for offer_id in set(map(str, offer_ids)):
+        watch = remnants_by_code.get(offer_id)
+        if watch is None:
+            continue
+        price = {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": offer_id,
+            "old_price": "0",
+            "price": price_conversion(watch["Цена"]),
+        }
+        prices.append(price)
     return prices
 
 
+@functools.lru_cache(maxsize=4096)
 def price_conversion(price: str) -> str:
     """Преобразовать цену в строку с только цифрами. Пример: 5'990.00 руб. -> '5990'
     
@@ -263,104 +407,120 @@ def price_conversion(price: str) -> str:
         >>> price_conversion("")
         ''
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    head = price.partition(".")[0]
+    return head if head.isdigit() else _NON_DIGIT.sub("", head)
 
 
 
 def divide(lst: list, n: int):
     """Разделить список lst на части по n элементов
-        
+
     Args:
-        lst (list): Список чего-либо
+        lst (list): Список или любой другой итерируемый объект
         n (int): Максимальное кол-во элементов в списке
-        
+
     Yield:
         Возвращает разделенные списки по n элментов внутри
-        
+
     Примеры корректного использования:
         >>> lst = [1, 2, 3, 4, 5, 6, 7, 8]
         >>> n = 3
-        >>> print(divide(lst: list, n: int))
+        >>> for chunk in divide(lst, n):
+        ...     print(chunk)
         [1, 2, 3]
         [4, 5, 6]
         [7, 8]
-    
+
     Примеры некорректного использования:
         >>> print(list(divide([], 3)))
         []
     """
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    iterator = iter(lst)
+    while chunk := list(islice(iterator, n)):
+        yield chunk
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def upload_prices(watch_remnants, client_id, seller_token, session, offer_ids=None):
     """Асинхронная загрузка цен на платформу Ozon.
-    
+
     Args:
         watch_remnants (list): Список остатков товаров, загруженных с сайта Casio.
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+        offer_ids (set): Заранее полученные артикулы товаров; если не переданы,
+            запрашиваются у API.
+
     Returns:
         list: Список обновленных цен.
-        
+
     Пример корректного использования:
-        >>> await upload_prices([{"Код": "123", "Цена": "5990 руб."}], "client_id", "token")
+        >>> await upload_prices([{"Код": "123", "Цена": "5990 руб."}], "client_id", "token", session)
         [{"offer_id": "123", "price": "5990"}]
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(client_id, seller_token, session)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await gather_limited(
+        update_price(some_price, client_id, seller_token, session)
+        for some_price in divide(prices, 1000)
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, client_id, seller_token, session, offer_ids=None):
     """Асинхронная загрузка остатков на платформу Ozon.
-    
+
     Args:
         watch_remnants (list): Список остатков товаров, загруженных с сайта Casio.
         client_id (str): Идентификатор клиента для API Ozon.
         seller_token (str): Токен продавца для авторизации на API Ozon.
-        
+        session (aiohttp.ClientSession): Сессия с общим пулом соединений.
+        offer_ids (set): Заранее полученные артикулы товаров; если не переданы,
+            запрашиваются у API.
+
     Returns:
         tuple: Списки обновленных и всех остатков.
-        
+
     Пример корректного использования:
-        >>> await upload_stocks([{"Код": "123", "Количество": "10"}], "client_id", "token")
+        >>> await upload_stocks([{"Код": "123", "Количество": "10"}], "client_id", "token", session)
         ([{"offer_id": "123", "stock": 10}], [{"offer_id": "123", "stock": 10}])
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(client_id, seller_token, session)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await gather_limited(
+        update_stocks(some_stock, client_id, seller_token, session)
+        for some_stock in divide(stocks, 100)
+    )
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
-def main():
+async def main():
     """Основная функция, запускающая процесс обновления цен и остатков на платформе Ozon."""
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        async with make_session() as session:
+            offer_ids = await get_offer_ids(client_id, seller_token, session)
+            watch_remnants = download_stock()
+            # Обновить остатки
+            await upload_stocks(
+                watch_remnants, client_id, seller_token, session, offer_ids=offer_ids
+            )
+            # Поменять цены
+            await upload_prices(
+                watch_remnants, client_id, seller_token, session, offer_ids=offer_ids
+            )
+    except (asyncio.TimeoutError, requests.exceptions.ReadTimeout):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (aiohttp.ClientConnectionError, requests.exceptions.ConnectionError) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())